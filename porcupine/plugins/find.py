@@ -1,19 +1,15 @@
 """Find and replace text."""
 from __future__ import annotations
 
+import bisect
+import itertools
 import re
-import sys
 import tkinter
 import weakref
-from functools import partial
+from functools import lru_cache, partial
 from tkinter import ttk
 from typing import Any, Callable, Iterator, TypeVar, cast
 
-if sys.version_info >= (3, 8):
-    from typing import Literal
-else:
-    from typing_extensions import Literal
-
 from porcupine import get_tab_manager, images, menubar, tabs, textutils
 
 CallableT = TypeVar("CallableT", bound=Callable[..., Any])
@@ -52,6 +48,36 @@ def method_weakref(method: CallableT) -> CallableT:
     return lambda *args, **kwargs: method_ref()(*args, **kwargs)  # type: ignore
 
 
+# Called every time something is typed to the find entry. Most of the time
+# the searched text is the same as some time before, e.g. because backspace
+# was pressed or a checkbox was toggled.
+#
+# The searched text is always escaped, so these regexes contain no repetition
+# or alternation and can't backtrack catastrophically. With \b or IGNORECASE,
+# matching isn't linear time (worst case len(text) * len(looking4)), but it
+# can't blow up exponentially either.
+@lru_cache(maxsize=64)
+def _compile_regex(looking4: str, full_words: bool, ignore_case: bool) -> re.Pattern[str]:
+    if full_words:
+        regex = r"\b" + re.escape(looking4) + r"\b"
+    else:
+        regex = re.escape(looking4)
+    return re.compile(regex, re.IGNORECASE if ignore_case else 0)
+
+
+# Faster than regexes when searching plain text. str.find() uses a
+# string search algorithm that skips ahead, and memchr() is fast.
+def _find_all(text: str, looking4: str) -> Iterator[int]:
+    start = text.find(looking4)
+    while start != -1:
+        yield start
+        start = text.find(looking4, start + len(looking4))
+
+
+# How many matches _highlight_in_chunks() highlights before letting Tk run other things
+_CHUNK_SIZE = 500
+
+
 class Finder(ttk.Frame):
     """A widget for finding and replacing text.
 
@@ -62,6 +88,33 @@ class Finder(ttk.Frame):
         super().__init__(parent, **kwargs)
         self._textwidget = textwidget
 
+        # Names of the "find_match_123" tags, in the order they appear in the text.
+        # Asking Tk with tag_names() is slow when the highlight plugin has added
+        # lots of tags, and buttons are updated whenever the selection changes.
+        self._match_tags: list[str] = []
+
+        # Where each match tag starts as (line, column), for binary searching
+        # the match after or before the cursor, and (start, end) of each match,
+        # for checking whether the selection is a match. None if the text has
+        # changed, see _get_match_positions().
+        self._match_starts: list[tuple[int, int]] | None = []
+        self._match_ranges: set[tuple[str, str]] | None = set()
+
+        # Exactly the ranges that have "find_highlight", or None if we don't know.
+        # This isn't the same as _match_ranges after editing: text typed between
+        # two adjacent matches gets "find_highlight" but no "find_match_123" tag.
+        self._highlighted_ranges: set[tuple[str, str]] | None = set()
+
+        # Highlighting happens in chunks when there are lots of matches, see
+        # _highlight_in_chunks(). These are not None while it's in progress.
+        self._highlighting: Iterator[None] | None = None
+        self._highlight_after_id: str | None = None
+
+        # Content of the text widget and where each line starts in it, or None
+        # if it changed since last search. Typing to the find entry doesn't
+        # change it.
+        self._text_cache: tuple[str, list[int]] | None = None
+
         # grid layout:
         #           column 0         column 1           column 2       column 3
         #       ,------------------------------------------------------------.
@@ -150,6 +203,11 @@ class Finder(ttk.Frame):
         # catch highlight issue after undo
         textwidget.bind("<<Undo>>", self._handle_undo, add=True)
 
+        # invalidate cached text, and chunks not highlighted yet would go to
+        # wrong places after editing
+        textwidget.bind("<<ContentChanged>>", self._on_content_changed, add=True)
+        self.bind("<Destroy>", self._stop_highlighting, add=True)
+
     def _config_tags(self, junk: object = None) -> None:
         # TODO: use more pygments theme instead of hard-coded colors?
         self._textwidget.tag_config("find_highlight", foreground="black", background="yellow")
@@ -197,18 +255,30 @@ class Finder(ttk.Frame):
         self.update_idletasks()
 
     def get_match_tags(self, index: str | None = None) -> list[str]:
+        if index is None:
+            return self._match_tags.copy()
         return [tag for tag in self._textwidget.tag_names(index) if tag.startswith("find_match_")]
 
     # Deleting and removing a tag are different concepts.
     # Deleting means that the whole tag is gone.
     # Removing means that there are no characters using the tag.
     def _delete_match_tags(self) -> None:
+        if self._match_tags:
+            # One call for all tags, there can be thousands of them
+            self._textwidget.tag_delete(*self._match_tags)
+            self._match_tags.clear()
+        self._match_starts = []
+        self._match_ranges = set()
+
+    def _unhighlight_all(self) -> None:
         self._textwidget.tag_remove("find_highlight", "1.0", "end")
-        for tag in self.get_match_tags():
-            self._textwidget.tag_delete(tag)
+        self._highlighted_ranges = set()
 
     def hide(self, junk: object = None) -> None:
+        self._stop_highlighting()
         self._delete_match_tags()
+        self._unhighlight_all()
+        self._text_cache = None  # can be big
         self._textwidget.tag_remove("find_highlight_selected", "1.0", "end")
         self.pack_forget()
         self._textwidget.focus_set()
@@ -220,7 +290,7 @@ class Finder(ttk.Frame):
     # must be called when going to another match or replacing becomes possible
     # or impossible, i.e. when find_highlight areas or the selection changes
     def _update_buttons(self, junk: object = None) -> None:
-        matches_something_state = "normal" if self.get_match_tags() else "disabled"
+        matches_something_state = "normal" if self._match_tags else "disabled"
         self.previous_button.config(state=matches_something_state)
         self.next_button.config(state=matches_something_state)
         self.replace_all_button.config(state=matches_something_state)
@@ -231,68 +301,155 @@ class Finder(ttk.Frame):
         #   - "find_highlight_selected" (text is orange)
         #   - "find_match_123" (it is actually a match)
 
-        locations = self._tag_ranges("sel")
-        locations2 = self._tag_ranges("find_highlight_selected")
+        try:
+            start = self._textwidget.index("sel.first")
+            end = self._textwidget.index("sel.last")
+        except tkinter.TclError:
+            # nothing selected
+            self.replace_this_button.config(state="disabled")
+            return
+
         if (
-            len(locations) == 2
-            and locations == locations2
-            and any(self._tag_ranges(t) == locations for t in self.get_match_tags("sel.first"))
+            self._tag_ranges("find_highlight_selected") == [start, end]
+            and (start, end) in self._get_match_positions()[1]
         ):
             self.replace_this_button.config(state="normal")
         else:
             self.replace_this_button.config(state="disabled")
 
-    def _get_matches_to_highlight(self, looking4: str) -> Iterator[str]:
+    def _get_matches_to_highlight(self, looking4: str) -> Iterator[tuple[str, str]]:
         # Tkinter's .search() is slow when there are lots of tags from highlight plugin.
         # See "PERFORMANCE ISSUES" in text widget manual page
-        text = self._textwidget.get("1.0", "end - 1 char")
-
-        if self.full_words_var.get():
-            regex = r"\b" + re.escape(looking4) + r"\b|\n"
+        if self._text_cache is None:
+            text = self._textwidget.get("1.0", "end - 1 char")
+
+            # Tk wants line and column numbers. Find where lines start, so that
+            # each match can be converted with a binary search.
+            line_starts = [0]
+            line_starts.extend(match.end() for match in re.finditer("\n", text))
+            self._text_cache = (text, line_starts)
+
+        text, line_starts = self._text_cache
+
+        full_words = self.full_words_var.get()
+        ignore_case = self.ignore_case_var.get()
+        if full_words or ignore_case:
+            regex = _compile_regex(looking4, full_words, ignore_case)
+            match_starts: Iterator[int] = (m.start() for m in regex.finditer(text))
         else:
-            regex = re.escape(looking4) + "|\n"
-        flags = re.IGNORECASE if self.ignore_case_var.get() else 0
-
-        lineno = 1
-        for match in re.finditer(regex, text, flags):
-            if match.group(0) == "\n":
-                lineno += 1
+            match_starts = _find_all(text, looking4)
+
+        # This loop runs once for each match, so avoid repeated lookups
+        bisect_right = bisect.bisect_right
+        length = len(looking4)
+        multiline = "\n" in looking4
+
+        for start in match_starts:
+            lineno = bisect_right(line_starts, start)
+            column = start - line_starts[lineno - 1]
+            # Much faster than letting Tk figure out "+ n chars"
+            if multiline:
+                end = start + length
+                end_lineno = bisect_right(line_starts, end)
+                end_column = end - line_starts[end_lineno - 1]
             else:
-                if lineno == 1:
-                    column = match.start()
-                else:
-                    column = match.start() - text.rindex("\n", 0, match.start()) - 1
-                yield f"{lineno}.{column}"
+                end_lineno = lineno
+                end_column = column + length
+            yield (f"{lineno}.{column}", f"{end_lineno}.{end_column}")
 
     def highlight_all_matches(self, *junk: object) -> None:
+        # Hidden finder has nothing highlighted, and show() highlights again.
+        # Can't use winfo_ismapped(), because show() calls this right after
+        # packing, before Tk gets to actually display the finder.
+        if not self.winfo_manager():
+            return
+
+        # Often many of the same matches are found again, e.g. when pressing
+        # backspace or toggling a checkbox. Their "find_highlight" can stay,
+        # if we know exactly what is highlighted.
+        if self._highlighted_ranges is not None:
+            old_ranges = self._highlighted_ranges
+        else:
+            self._unhighlight_all()
+            old_ranges = set()
+        self._highlighted_ranges = None  # not known until highlighting finishes
+
+        self._stop_highlighting()
         self._delete_match_tags()
 
         looking4 = self.find_entry.get()
         if not looking4:  # don't search for empty string
+            self._unhighlight_all()
             self._update_buttons()
             self.statuslabel.config(text="Type something to find.")
             return
         if self.full_words_var.get() and not re.fullmatch(r"\w|\w.*\w", looking4):
+            self._unhighlight_all()
             self._update_buttons()
             self.statuslabel.config(
                 text=f'"{looking4}" is not a valid word. Maybe uncheck "Full words only"?'
             )
             return
 
+        self._highlighting = self._highlight_in_chunks(looking4, old_ranges)
+        self._highlight_next_chunk()
+
+    # Tagging thousands of matches takes a while. Doing it in chunks and
+    # letting Tk handle events in between keeps typing to the find entry
+    # responsive, because each key press starts over.
+    def _highlight_in_chunks(
+        self, looking4: str, old_ranges: set[tuple[str, str]]
+    ) -> Iterator[None]:
+        matches = self._get_matches_to_highlight(looking4)
         count = 0
-        for start_index in self._get_matches_to_highlight(looking4):
+        added_indexes = []
+        tag_add = self._textwidget.tag_add
+        add_match_tag = self._match_tags.append
+
+        while True:
             # Both tags needed:
             #   - "find_highlight" to display with yellow color in gui
             #   - "find_match_123" to distinguish matches, even when repeated
-            self._textwidget.tag_add(
-                "find_highlight", start_index, f"{start_index} + {len(looking4)} chars"
-            )
-            self._textwidget.tag_add(
-                f"find_match_{count}", start_index, f"{start_index} + {len(looking4)} chars"
+            #
+            # Tag add accepts any number of start,end pairs. Adding "find_highlight"
+            # with one call is much faster than one call per match.
+            chunk = list(itertools.islice(matches, _CHUNK_SIZE))
+            starts, ranges = self._get_match_positions()
+            highlight_indexes = []
+            for start_index, end_index in chunk:
+                tag_add(f"find_match_{count}", start_index, end_index)
+                add_match_tag(f"find_match_{count}")
+                line, column = map(int, start_index.split("."))
+                starts.append((line, column))
+                ranges.add((start_index, end_index))
+                if (start_index, end_index) not in old_ranges:
+                    highlight_indexes.extend([start_index, end_index])
+                count += 1
+
+            if highlight_indexes:
+                tag_add("find_highlight", *highlight_indexes)
+                added_indexes.extend(highlight_indexes)
+            self._update_buttons()
+
+            if len(chunk) < _CHUNK_SIZE:
+                break
+            self.statuslabel.config(text=f"Found {count} matches so far...")
+            yield
+
+        # Unhighlight old matches that weren't found again. A removed match can
+        # overlap a new match, e.g. "asd" in "asdasd" vs "sda", so highlight
+        # the new matches again. Tkinter's tag_remove() takes only one range.
+        removed_ranges = old_ranges - self._get_match_positions()[1]
+        if removed_ranges:
+            removed_indexes = itertools.chain.from_iterable(removed_ranges)
+            self._textwidget.tk.call(
+                self._textwidget, "tag", "remove", "find_highlight", *removed_indexes
             )
-            count += 1
+            if added_indexes:
+                self._textwidget.tag_add("find_highlight", *added_indexes)
+
+        self._highlighted_ranges = self._get_match_positions()[1].copy()
 
-        self._update_buttons()
         if count == 0:
             self.statuslabel.config(text="Found no matches :(")
         elif count == 1:
@@ -300,6 +457,67 @@ class Finder(ttk.Frame):
         else:
             self.statuslabel.config(text=f"Found {count} matches.")
 
+    def _highlight_next_chunk(self) -> None:
+        assert self._highlighting is not None
+        try:
+            next(self._highlighting)
+        except StopIteration:
+            self._highlighting = None
+            self._highlight_after_id = None
+        else:
+            self._highlight_after_id = self.after_idle(self._highlight_next_chunk)
+
+    def _stop_highlighting(self, junk: object = None) -> None:
+        if self._highlight_after_id is not None:
+            self.after_cancel(self._highlight_after_id)
+        self._highlighting = None
+        self._highlight_after_id = None
+
+    # Call this before doing something that needs all matches
+    def _finish_highlighting(self) -> None:
+        highlighting = self._highlighting
+        if highlighting is not None:
+            self._stop_highlighting()
+            for junk in highlighting:
+                pass
+
+    def _on_content_changed(self, junk: object) -> None:
+        self._text_cache = None
+        self._forget_match_positions()
+        self._highlighted_ranges = None
+        if self._highlighting is not None:
+            self.highlight_all_matches()
+
+    # Tags move when the text changes, so after changing the text, we need to
+    # ask Tk where they are. Otherwise we already know.
+    def _forget_match_positions(self) -> None:
+        self._match_starts = None
+        self._match_ranges = None
+
+    def _get_match_positions(self) -> tuple[list[tuple[int, int]], set[tuple[str, str]]]:
+        if self._match_starts is None or self._match_ranges is None:
+            self._match_starts = []
+            self._match_ranges = set()
+            kept_tags = []
+            for tag in self._match_tags:
+                tag_ranges = self._tag_ranges(tag)
+                if tag_ranges:
+                    start, end = tag_ranges
+                    line, column = map(int, start.split("."))
+                    self._match_starts.append((line, column))
+                    self._match_ranges.add((start, end))
+                    kept_tags.append(tag)
+
+            # Deleting all text of a match leaves its tag with no ranges
+            if len(kept_tags) != len(self._match_tags):
+                self._textwidget.tag_delete(*set(self._match_tags) - set(kept_tags))
+                self._match_tags[:] = kept_tags
+        return (self._match_starts, self._match_ranges)
+
+    def _get_cursor_pos(self) -> tuple[int, int]:
+        line, column = map(int, self._textwidget.index("insert").split("."))
+        return (line, column)
+
     def _select_match(self, match_tags: list[str], index: int) -> None:
         tag = match_tags[index]
         self._textwidget.tag_remove("sel", "1.0", "end")
@@ -315,34 +533,33 @@ class Finder(ttk.Frame):
     def _go_to_next_match(self, junk: object = None) -> None:
         # If we have no matches, then "Next match" button is disabled and
         # this was invoked through key binding
+        self._finish_highlighting()
+        starts = self._get_match_positions()[0]  # may forget matches whose text was deleted
         tags = self.get_match_tags()
         if tags:
             # If no matches highlighted yet, can highlight match exactly at cursor
             # Applies only to next match, previous always search before cursor
             some_match_already_highlighted = str(self.replace_this_button["state"]) == "normal"
-            operator: Literal[">=", ">"] = ">" if some_match_already_highlighted else ">="
+            cursor_pos = self._get_cursor_pos()
 
-            # find first pair that starts after the cursor, or cycle back to first
-            possible_indexes = (
-                i
-                for i, tag in enumerate(tags)
-                if self._textwidget.compare(f"{tag}.first", operator, "insert")
-            )
-            index = next(possible_indexes, 0)
-            self._select_match(tags, index)
+            # find first match that starts after the cursor, or cycle back to first
+            if some_match_already_highlighted:
+                index = bisect.bisect_right(starts, cursor_pos)
+            else:
+                index = bisect.bisect_left(starts, cursor_pos)
+            self._select_match(tags, index % len(tags))
 
     def _go_to_previous_match(self, junk: object = None) -> None:
+        self._finish_highlighting()
+        starts = self._get_match_positions()[0]  # may forget matches whose text was deleted
         tags = self.get_match_tags()
         if tags:
-            possible_indexes = (
-                i
-                for i, tag in reversed(list(enumerate(tags)))
-                if self._textwidget.compare(f"{tag}.first", "<", "insert")
-            )
-            index = next(possible_indexes, len(tags) - 1)
-            self._select_match(tags, index)
+            # find last match that starts before the cursor, or cycle back to last
+            index = bisect.bisect_left(starts, self._get_cursor_pos()) - 1
+            self._select_match(tags, index % len(tags))
 
     def _replace_this(self, junk: object = None) -> str:
+        self._finish_highlighting()
         if str(self.replace_this_button["state"]) == "disabled":
             self.statuslabel.config(text='Click "Previous match" or "Next match" first.')
             return "break"
@@ -355,6 +572,9 @@ class Finder(ttk.Frame):
         with textutils.change_batch(self._textwidget):
             self._textwidget.replace(f"{tag}.first", f"{tag}.last", self.replace_entry.get())
         self._textwidget.tag_delete(tag)
+        self._match_tags.remove(tag)
+        self._forget_match_positions()
+        self._highlighted_ranges = None
 
         self._go_to_next_match()
 
@@ -368,6 +588,7 @@ class Finder(ttk.Frame):
         return "break"
 
     def _replace_all(self, junk: object = None) -> str:
+        self._finish_highlighting()
         match_tags = self.get_match_tags()
 
         with textutils.change_batch(self._textwidget):
@@ -375,6 +596,7 @@ class Finder(ttk.Frame):
                 self._textwidget.replace(f"{tag}.first", f"{tag}.last", self.replace_entry.get())
 
         self._delete_match_tags()
+        self._unhighlight_all()
         self._update_buttons()
 
         if len(match_tags) == 1:
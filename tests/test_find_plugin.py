@@ -469,3 +469,72 @@ def test_find_r_from_rr(filetab_and_finder):
     finder.show()
     finder.find_entry.insert("end", "r")
     assert get_match_ranges(finder) == [("1.0", "1.1"), ("1.1", "1.2")]
+
+
+def test_deleted_match(filetab_and_finder):
+    filetab, finder = filetab_and_finder
+    filetab.textwidget.insert("end", "foo bar foo")
+    finder.find_entry.insert("end", "foo")
+
+    filetab.textwidget.delete("1.8", "end")
+    finder.next_button.invoke()
+    assert finder.statuslabel["text"] == "Match 1/1"
+    assert get_match_ranges(finder) == [("1.0", "1.3")]
+
+
+def test_lots_of_matches(filetab_and_finder):
+    filetab, finder = filetab_and_finder
+    filetab.textwidget.insert("end", "x " * 1234)
+
+    # Only some matches are highlighted right away, so that typing stays fast
+    finder.find_entry.insert("end", "x")
+    assert finder.statuslabel["text"] == f"Found {find._CHUNK_SIZE} matches so far..."
+    filetab.update()
+    assert finder.statuslabel["text"] == "Found 1234 matches."
+    assert len(finder.get_match_tags()) == 1234
+
+    # Going to a match must not miss matches that aren't highlighted yet
+    finder.find_entry.insert(0, " ")
+    assert finder.statuslabel["text"] == f"Found {find._CHUNK_SIZE} matches so far..."
+    finder.next_button.invoke()
+    assert finder.statuslabel["text"] == "Match 1/1233"
+    assert len(finder.get_match_tags()) == 1233
+
+
+def test_multiline_match(filetab_and_finder):
+    filetab, finder = filetab_and_finder
+    filetab.textwidget.insert("end", "foo\nbar\nfoo\nbar")
+    finder.find_entry.insert("end", "foo\nbar")
+    assert get_match_ranges(finder) == [("1.0", "2.3"), ("3.0", "4.3")]
+
+    finder.next_button.invoke()
+    assert str(finder.replace_this_button["state"]) == "normal"
+
+
+def test_rehighlight_overlapping_matches(filetab_and_finder):
+    filetab, finder = filetab_and_finder
+    filetab.textwidget.insert("end", "asdasd")
+
+    finder.find_entry.insert("end", "asd")
+    assert list(map(str, filetab.textwidget.tag_ranges("find_highlight"))) == ["1.0", "1.6"]
+
+    # new match overlaps both old matches, must stay highlighted
+    finder.find_entry.insert("end", "a")
+    assert list(map(str, filetab.textwidget.tag_ranges("find_highlight"))) == ["1.0", "1.4"]
+
+
+def test_rehighlight_after_typing_between_matches(filetab_and_finder):
+    filetab, finder = filetab_and_finder
+    filetab.textwidget.insert("end", "rr")
+    finder.find_entry.insert("end", "r")
+
+    # The x gets find_highlight from both sides, but it's not in any match
+    filetab.textwidget.insert("1.1", "x")
+    finder.next_button.invoke()
+    finder.ignore_case_var.set(True)
+    assert list(map(str, filetab.textwidget.tag_ranges("find_highlight"))) == [
+        "1.0",
+        "1.1",
+        "1.2",
+        "1.3",
+    ]